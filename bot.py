@@ -1,22 +1,38 @@
 import logging
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, NetworkError, RetryAfter
 import time
 import secrets
-import json
+import orjson
 import os
-from datetime import datetime, timezone
-from flask import Flask, request
+from datetime import datetime
+from quart import Quart, request
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
 import asyncio
-from threading import Thread
-import requests
-import io
+import httpx
+import array
+import hashlib
+import hmac
+import atexit
+import heapq
+import functools
+import signal
+import tempfile
+import glob
+import contextlib
+from itertools import islice
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+BOT_TOKEN_BYTES = BOT_TOKEN.encode()
 PORT = int(os.environ.get("PORT", 8080))
+BOT_MODE = os.environ.get("BOT_MODE", "webhook").lower()  # "webhook" or "polling"
 
 # Storage files
 PAYLOAD_FILE = "payload_data.json"
@@ -24,143 +40,194 @@ ACCESS_FILE = "user_access.json"
 CAPTION_FILE = "caption_data.json"
 DELETION_FILE = "scheduled_deletions.json"
 BACKUP_IDS_FILE = "telegram_backup_ids.json"
+ACCESS_LOG_FILE = "user_access.log"
+ACCESS_LOG_ROTATED = "user_access.log.old"
+
+# Access log compaction
+COMPACT_INTERVAL = 300  # 5 minutes
+COMPACT_RATIO = 4
+
+# Telegram allows roughly 30 messages per second per bot
+SEND_RATE_LIMIT = 30
+
+# Bot API limit for copyMessages/deleteMessages
+MESSAGE_BATCH_SIZE = 100
+# Attempts per send before giving up on flood waits / connection failures
+SEND_RETRIES = 5
+# Transport errors raised before a request reached Telegram, so a retry cannot duplicate it
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Debounced saves
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 5))
+BACKUP_INTERVAL = float(os.environ.get("BACKUP_INTERVAL", 120))
+
+# Payloads shown per /listpayloads page (keeps replies under Telegram's 4096 chars)
+PAYLOADS_PER_PAGE = 20
+
+# Self-ping period; free hosts typically sleep after 15 idle minutes
+KEEP_ALIVE_INTERVAL = int(os.environ.get("KEEP_ALIVE_INTERVAL", 600))
+
+# Threads for blocking disk writes
+IO_WORKERS = 4
+
+# Deletions in the same chat falling in one window share a single entry
+DELETION_BUCKET = 60  # seconds
+
+# Invalid /start links allowed per user before replies stop
+INVALID_LINK_LIMIT = 5
+INVALID_LINK_WINDOW = 60  # seconds
+
+# Access record expiry (seconds, 0 keeps records forever)
+ACCESS_TTL = int(os.environ.get("ACCESS_TTL", 0))
+SWEEP_INTERVAL = 600  # 10 minutes
 
 payload_data = {}
 user_access = {}
+user_payloads = defaultdict(set)
 admin_sessions = {}
+caption_prompt_ids = deque(maxlen=32)
+bad_attempts = {}
 caption_data = {"start_caption": "", "end_caption": ""}
 scheduled_deletions = {}
 telegram_backup_ids = {}
+last_backup_digests = {}
+access_log = None
+deletion_heap = []
+deletion_wakeup = asyncio.Event()
+dirty_stores = set()
+cloud_backup_pending = set()
+flush_event = asyncio.Event()
+send_slots = asyncio.Semaphore(SEND_RATE_LIMIT)
+store_locks = {store: asyncio.Lock() for store in ('payload', 'access', 'caption', 'deletion')}
+# Held while admin handlers change payloads, captions or sessions across awaits
+state_lock = asyncio.Lock()
+
+# backup_to_telegram results
+BACKUP_UPLOADED = "uploaded"
+BACKUP_UNCHANGED = "unchanged"
+BACKUP_FAILED = "failed"
+
+NO_DATA_RESTART_MESSAGE = (
+    "🔄 Bot Restarted!\n\n"
+    "⚠️ No payload data found!\n\n"
+    "📤 Send your payload_data.json file anytime."
+)
 
 # Setup logging
+# PROD=1 keeps only warnings and errors so per-update INFO logs cost nothing
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=logging.WARNING if os.environ.get("PROD") == "1" else logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Flask app
-app = Flask(__name__)
+# Quart app
+app = Quart(__name__)
+# Telegram updates are a few KB; refuse anything far larger before reading it
+app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024
 
-# Bot application and event loop
+# Bot application
 bot_app = None
-bot_loop = None
+background_tasks = []
+
+def read_json_file(path, default):
+    """Read a JSON store, falling back to default if it is missing or unreadable"""
+    recover_tmp_file(path)
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'rb') as f:
+            data = orjson.loads(f.read())
+        logger.info("✅ Loaded %s from local file", path)
+        return data
+    except Exception as e:
+        logger.error("❌ Error loading %s: %s", path, e)
+        return default
 
 def load_backup_ids():
     """Load Telegram backup message IDs"""
     global telegram_backup_ids
-    if os.path.exists(BACKUP_IDS_FILE):
-        try:
-            with open(BACKUP_IDS_FILE, 'r') as f:
-                telegram_backup_ids = json.load(f)
-            logger.info(f"✅ Loaded backup IDs: {telegram_backup_ids}")
-        except Exception as e:
-            logger.error(f"❌ Error loading backup IDs: {e}")
-            telegram_backup_ids = {}
-    else:
-        telegram_backup_ids = {}
+    telegram_backup_ids = read_json_file(BACKUP_IDS_FILE, {})
 
-def save_backup_ids():
+def save_backup_ids(content):
     """Save Telegram backup message IDs"""
     try:
-        with open(BACKUP_IDS_FILE, 'w') as f:
-            json.dump(telegram_backup_ids, f, indent=2)
-        logger.info("💾 Backup IDs saved")
+        write_file(BACKUP_IDS_FILE, content)
+        logger.debug("💾 Backup IDs saved")
     except Exception as e:
-        logger.error(f"❌ Error saving backup IDs: {e}")
+        logger.error("❌ Error saving backup IDs: %s", e)
 
-async def backup_to_telegram(bot, file_type, data, filename):
-    """Upload JSON data to Telegram as backup"""
+async def backup_to_telegram(bot, file_type, data, filename, force=False, json_bytes=None):
+    """Upload JSON data to Telegram as backup, skipping unchanged data unless forced"""
     try:
-        json_str = json.dumps(data, indent=2)
-        json_bytes = json_str.encode('utf-8')
-        file_obj = io.BytesIO(json_bytes)
-        file_obj.name = filename
+        if json_bytes is None:
+            json_bytes = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        digest = hashlib.blake2b(json_bytes, digest_size=16).digest()
+        if not force and last_backup_digests.get(file_type) == digest and file_type in telegram_backup_ids:
+            logger.info("☁️ %s unchanged since last backup, skipping upload", file_type)
+            return BACKUP_UNCHANGED
         
         sent_message = await bot.send_document(
             chat_id=ADMIN_ID,
-            document=file_obj,
+            document=json_bytes,
+            filename=filename,
             caption=f"☁️ Backup: {file_type.upper()}\n📅 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n📦 Records: {len(data) if isinstance(data, dict) else 'N/A'}",
             parse_mode=None
         )
         
         telegram_backup_ids[file_type] = sent_message.message_id
-        save_backup_ids()
+        last_backup_digests[file_type] = digest
+        await asyncio.to_thread(save_backup_ids, orjson.dumps(telegram_backup_ids, option=orjson.OPT_INDENT_2))
         
-        logger.info(f"☁️ Backed up {file_type} to Telegram (msg_id: {sent_message.message_id})")
-        return True
+        logger.info("☁️ Backed up %s to Telegram (msg_id: %s)", file_type, sent_message.message_id)
+        return BACKUP_UPLOADED
     except Exception as e:
-        logger.error(f"❌ Failed to backup {file_type} to Telegram: {e}")
-        return False
+        logger.error("❌ Failed to backup %s to Telegram: %s", file_type, e)
+        return BACKUP_FAILED
 
 async def restore_from_telegram(bot, file_type):
     """Download and restore JSON data from Telegram"""
     try:
         if file_type not in telegram_backup_ids:
-            logger.warning(f"⚠️ No backup ID found for {file_type}")
+            logger.warning("⚠️ No backup ID found for %s", file_type)
             return False, None
         
         message_id = telegram_backup_ids[file_type]
-        logger.info(f"📥 Restoring {file_type} from Telegram (msg_id: {message_id})")
+        logger.info("📥 Restoring %s from Telegram (msg_id: %s)", file_type, message_id)
         
         file = await bot.get_file(file_id=f"get_from_message_{message_id}")
         file_bytes = await file.download_as_bytearray()
-        json_str = file_bytes.decode('utf-8')
-        data = json.loads(json_str)
+        logger.info("📥 Downloaded %s bytes for %s", len(file_bytes), file_type)
+        data = orjson.loads(file_bytes)
         
-        logger.info(f"✅ Restored {file_type} from Telegram")
+        logger.info("✅ Restored %s from Telegram", file_type)
         return True, data
     except Exception as e:
-        logger.error(f"❌ Failed to restore {file_type} from Telegram: {e}")
+        logger.error("❌ Failed to restore %s from Telegram: %s", file_type, e)
         return False, None
 
+def normalize_access(raw):
+    """Key access records by int user ID with whole-second timestamps"""
+    return {
+        payload: {int(user_id): int(accessed_at) for user_id, accessed_at in users.items()}
+        for payload, users in raw.items()
+    }
+
 def load_data():
     """Load all data from files"""
     global payload_data, user_access, caption_data, scheduled_deletions
     
-    if os.path.exists(PAYLOAD_FILE):
-        try:
-            with open(PAYLOAD_FILE, 'r') as f:
-                payload_data = json.load(f)
-            logger.info(f"✅ Loaded {len(payload_data)} payloads from local file")
-        except Exception as e:
-            logger.error(f"❌ Error loading payloads: {e}")
-            payload_data = {}
-    else:
-        payload_data = {}
-    
-    if os.path.exists(ACCESS_FILE):
-        try:
-            with open(ACCESS_FILE, 'r') as f:
-                user_access = json.load(f)
-            logger.info(f"✅ Loaded user access data from local file")
-        except Exception as e:
-            logger.error(f"❌ Error loading access data: {e}")
-            user_access = {}
-    else:
-        user_access = {}
-    
-    if os.path.exists(CAPTION_FILE):
-        try:
-            with open(CAPTION_FILE, 'r') as f:
-                caption_data = json.load(f)
-            logger.info(f"✅ Loaded captions from local file")
-        except Exception as e:
-            logger.error(f"❌ Error loading captions: {e}")
-            caption_data = {"start_caption": "", "end_caption": ""}
-    else:
-        caption_data = {"start_caption": "", "end_caption": ""}
-    
-    if os.path.exists(DELETION_FILE):
-        try:
-            with open(DELETION_FILE, 'r') as f:
-                scheduled_deletions = json.load(f)
-            logger.info(f"✅ Loaded {len(scheduled_deletions)} scheduled deletions from local file")
-        except Exception as e:
-            logger.error(f"❌ Error loading deletions: {e}")
-            scheduled_deletions = {}
-    else:
-        scheduled_deletions = {}
+    payload_data = read_json_file(PAYLOAD_FILE, {})
+    user_access = normalize_access(read_json_file(ACCESS_FILE, {}))
+    caption_data = read_json_file(CAPTION_FILE, {"start_caption": "", "end_caption": ""})
+    scheduled_deletions = read_json_file(DELETION_FILE, {})
+    logger.info("📦 %s payloads, %s scheduled deletions", len(payload_data), len(scheduled_deletions))
+    
+    rebuild_deletion_heap()
+    replay_access_log()
+    rebuild_user_payloads()
+    if ACCESS_TTL:
+        expire_access()
 
 async def load_data_from_telegram(bot):
     """Try to load data from Telegram backups first"""
@@ -170,165 +237,515 @@ async def load_data_from_telegram(bot):
     
     restored_count = 0
     
-    success, data = await restore_from_telegram(bot, 'payload')
+    # Fetch all four backups at once; restore_from_telegram never raises
+    payload_result, access_result, caption_result, deletion_result = await asyncio.gather(
+        *(restore_from_telegram(bot, file_type) for file_type in ('payload', 'access', 'caption', 'deletion'))
+    )
+    
+    success, data = payload_result
     if success and data:
         payload_data = data
-        save_payloads()
+        await save_store_async('payload')
         restored_count += 1
-        logger.info(f"✅ Restored {len(payload_data)} payloads from Telegram")
+        logger.info("✅ Restored %s payloads from Telegram", len(payload_data))
     
-    success, data = await restore_from_telegram(bot, 'access')
+    success, data = access_result
     if success and data:
-        user_access = data
-        save_access()
+        user_access = normalize_access(data)
+        rebuild_user_payloads()
+        await save_access_async()
         restored_count += 1
-        logger.info(f"✅ Restored access data from Telegram")
+        logger.info("✅ Restored access data from Telegram")
     
-    success, data = await restore_from_telegram(bot, 'caption')
+    success, data = caption_result
     if success and data:
         caption_data = data
-        save_captions()
+        await save_store_async('caption')
         restored_count += 1
-        logger.info(f"✅ Restored captions from Telegram")
+        logger.info("✅ Restored captions from Telegram")
     
-    success, data = await restore_from_telegram(bot, 'deletion')
+    success, data = deletion_result
     if success and data:
         scheduled_deletions = data
-        save_deletions()
+        rebuild_deletion_heap()
+        await save_store_async('deletion')
         restored_count += 1
-        logger.info(f"✅ Restored {len(scheduled_deletions)} deletions from Telegram")
+        logger.info("✅ Restored %s deletions from Telegram", len(scheduled_deletions))
     
     if restored_count > 0:
-        logger.info(f"🎉 Successfully restored {restored_count} file(s) from Telegram!")
+        logger.info("🎉 Successfully restored %s file(s) from Telegram!", restored_count)
         return True
     else:
         logger.warning("⚠️ No data restored from Telegram, using local files")
         return False
 
+def write_file(path, content):
+    """Atomically replace a file with serialized content"""
+    # A unique temp name per write keeps overlapping writers off each other's file
+    with tempfile.NamedTemporaryFile(
+        'wb', dir=os.path.dirname(path) or '.', prefix=f"{os.path.basename(path)}.", suffix='.tmp', delete=False
+    ) as f:
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+def recover_tmp_file(path):
+    """Promote the newest complete temp file if the real one was never written"""
+    tmp_paths = sorted(glob.glob(f"{glob.escape(path)}.*.tmp"), key=os.path.getmtime, reverse=True)
+    for tmp_path in tmp_paths:
+        if not os.path.exists(path):
+            try:
+                # A crash mid-write leaves truncated JSON; never install that as the real file
+                with open(tmp_path, 'rb') as f:
+                    orjson.loads(f.read())
+            except (OSError, orjson.JSONDecodeError) as e:
+                logger.warning("⚠️ Discarding incomplete %s: %s", tmp_path, e)
+            else:
+                os.replace(tmp_path, path)
+                logger.warning("⚠️ Recovered %s from %s", path, tmp_path)
+                continue
+        os.remove(tmp_path)
+
 def save_payloads():
     """Save payload data"""
     try:
-        with open(PAYLOAD_FILE, 'w') as f:
-            json.dump(payload_data, f, indent=2)
-        logger.info("💾 Payloads saved locally")
+        write_file(PAYLOAD_FILE, orjson.dumps(payload_data))
+        logger.debug("💾 Payloads saved locally")
     except Exception as e:
-        logger.error(f"❌ Error saving payloads: {e}")
+        logger.error("❌ Error saving payloads: %s", e)
 
 def save_access():
-    """Save user access data"""
+    """Save user access snapshot and truncate the access log"""
+    global access_log
+    try:
+        write_file(ACCESS_FILE, orjson.dumps(user_access, option=orjson.OPT_NON_STR_KEYS))
+        
+        if access_log is not None:
+            access_log.close()
+        access_log = open(ACCESS_LOG_FILE, 'wb', buffering=0)
+        if os.path.exists(ACCESS_LOG_ROTATED):
+            os.remove(ACCESS_LOG_ROTATED)
+        logger.debug("💾 Access data saved locally")
+    except Exception as e:
+        logger.error("❌ Error saving access: %s", e)
+
+def write_access_snapshot(snapshot):
+    """Serialize and write an access snapshot (runs in a worker thread)"""
+    write_file(ACCESS_FILE, orjson.dumps(snapshot, option=orjson.OPT_NON_STR_KEYS))
+
+async def save_access_async():
+    """Rotate the access log on the loop and write the snapshot from a worker thread"""
+    global access_log
     try:
-        with open(ACCESS_FILE, 'w') as f:
-            json.dump(user_access, f, indent=2)
-        logger.info("💾 Access data saved locally")
+        async with store_locks['access']:
+            dirty_stores.discard('access')
+            # Copy and rotate with no await in between, so every append lands in exactly one of them
+            snapshot = {payload: dict(users) for payload, users in user_access.items()}
+            if access_log is not None:
+                access_log.close()
+                access_log = None  # append_access reopens a fresh log
+            # A rotated log left by a failed save still has records the snapshot on disk lacks
+            if os.path.exists(ACCESS_LOG_FILE) and not os.path.exists(ACCESS_LOG_ROTATED):
+                os.replace(ACCESS_LOG_FILE, ACCESS_LOG_ROTATED)
+            
+            await asyncio.to_thread(write_access_snapshot, snapshot)
+            
+            if os.path.exists(ACCESS_LOG_ROTATED):
+                os.remove(ACCESS_LOG_ROTATED)
+        logger.debug("💾 Access data saved locally")
     except Exception as e:
-        logger.error(f"❌ Error saving access: {e}")
+        logger.error("❌ Error saving access: %s", e)
+
+def append_access(payload, user_id, timestamp):
+    """Append a single access record to the access log"""
+    global access_log
+    try:
+        if access_log is None:
+            access_log = open(ACCESS_LOG_FILE, 'ab', buffering=0)
+        access_log.write(orjson.dumps({"op": "access", "p": payload, "u": user_id, "t": timestamp}) + b"\n")
+    except Exception as e:
+        logger.error("❌ Error appending access log: %s", e)
+
+def record_access(payload, user_id, timestamp):
+    """Record an access in memory and in the per-user index"""
+    user_access.setdefault(payload, {})[user_id] = timestamp
+    user_payloads[user_id].add(payload)
+
+def rebuild_user_payloads():
+    """Index accessed payloads by user"""
+    user_payloads.clear()
+    for payload, users in user_access.items():
+        for user_id in users:
+            user_payloads[user_id].add(payload)
+
+def replay_access_log():
+    """Apply access log records on top of the loaded snapshot"""
+    replayed = 0
+    # A rotated log is older than the live one, so it is applied first
+    for log_path in (ACCESS_LOG_ROTATED, ACCESS_LOG_FILE):
+        if not os.path.exists(log_path):
+            continue
+        try:
+            with open(log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue  # torn last line after a crash
+                    if record.get("op") == "access":
+                        record_access(record["p"], int(record["u"]), int(record["t"]))
+                        replayed += 1
+        except Exception as e:
+            logger.error("❌ Error replaying %s: %s", log_path, e)
+    if replayed:
+        logger.info("✅ Replayed %s access record(s) from log", replayed)
+
+async def access_log_compactor():
+    """Periodically fold the access log into the snapshot once it grows too large"""
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        try:
+            if not os.path.exists(ACCESS_LOG_FILE):
+                continue
+            log_size = os.path.getsize(ACCESS_LOG_FILE)
+            snapshot_size = os.path.getsize(ACCESS_FILE) if os.path.exists(ACCESS_FILE) else 0
+            if log_size > COMPACT_RATIO * max(snapshot_size, 1024):
+                await save_access_async()
+                logger.info("🗜️ Compacted access log (%s bytes)", log_size)
+        except Exception as e:
+            logger.error("❌ Access log compaction failed: %s", e)
+
+def expire_access():
+    """Drop access records older than ACCESS_TTL"""
+    cutoff = int(time.time()) - ACCESS_TTL
+    expired = 0
+    for payload, users in list(user_access.items()):
+        for user_id in [uid for uid, ts in users.items() if ts < cutoff]:
+            del users[user_id]
+            user_payloads[user_id].discard(payload)
+            if not user_payloads[user_id]:
+                del user_payloads[user_id]
+            expired += 1
+        if not users:
+            del user_access[payload]
+    if expired:
+        mark_dirty('access')
+        logger.info("🧹 Expired %s access record(s)", expired)
+
+async def access_sweeper():
+    """Periodically expire old access records"""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        expire_access()
 
 def save_captions():
     """Save caption data"""
     try:
-        with open(CAPTION_FILE, 'w') as f:
-            json.dump(caption_data, f, indent=2)
-        logger.info("💾 Captions saved locally")
+        write_file(CAPTION_FILE, orjson.dumps(caption_data))
+        logger.debug("💾 Captions saved locally")
     except Exception as e:
-        logger.error(f"❌ Error saving captions: {e}")
+        logger.error("❌ Error saving captions: %s", e)
 
 def save_deletions():
     """Save scheduled deletions"""
     try:
-        with open(DELETION_FILE, 'w') as f:
-            json.dump(scheduled_deletions, f, indent=2)
-        logger.info("💾 Deletions saved locally")
+        write_file(DELETION_FILE, orjson.dumps(scheduled_deletions))
+        logger.debug("💾 Deletions saved locally")
+    except Exception as e:
+        logger.error("❌ Error saving deletions: %s", e)
+
+async def save_store_async(store, content=None):
+    """Serialize a store on the loop (unless content is given) and write it from a worker thread"""
+    if store == 'access':
+        # The snapshot has to be paired with an access log rotation
+        await save_access_async()
+        return
+    
+    path, data = {
+        'payload': (PAYLOAD_FILE, payload_data),
+        'caption': (CAPTION_FILE, caption_data),
+        'deletion': (DELETION_FILE, scheduled_deletions),
+    }[store]
+    try:
+        async with store_locks[store]:
+            # Cleared only once the lock is held, so a cancelled wait leaves the store dirty
+            dirty_stores.discard(store)
+            if content is None:
+                content = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            await asyncio.to_thread(write_file, path, content)
+        logger.debug("💾 %s data saved locally", store.capitalize())
+    except Exception as e:
+        logger.error("❌ Error saving %s data: %s", store, e)
+
+def mark_dirty(store):
+    """Queue a store for the next background flush"""
+    dirty_stores.add(store)
+    flush_event.set()
+
+def flush_dirty_stores():
+    """Write every dirty store to disk"""
+    savers = {
+        'payload': save_payloads,
+        'access': save_access,
+        'caption': save_captions,
+        'deletion': save_deletions,
+    }
+    while dirty_stores:
+        savers[dirty_stores.pop()]()
+
+async def dirty_store_flusher():
+    """Coalesce saves so each store is written at most once per FLUSH_INTERVAL"""
+    while True:
+        await flush_event.wait()
+        await asyncio.sleep(FLUSH_INTERVAL)
+        flush_event.clear()
+        while dirty_stores:
+            await save_store_async(next(iter(dirty_stores)))
+
+atexit.register(flush_dirty_stores)
+
+def mark_backup(store):
+    """Queue a store for the next Telegram backup"""
+    cloud_backup_pending.add(store)
+
+BACKUP_SOURCES = {
+    'payload': (lambda: payload_data, 'payload_data.json'),
+    'caption': (lambda: caption_data, 'caption_data.json'),
+}
+
+async def backup_store_now(bot, store):
+    """Write a store to disk and Telegram right away, queueing a retry if the upload fails"""
+    get_data, filename = BACKUP_SOURCES[store]
+    data = get_data()
+    # One serialization feeds both the disk write and the upload
+    json_bytes = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    await save_store_async(store, json_bytes)
+    if await backup_to_telegram(bot, store, data, filename, json_bytes=json_bytes) != BACKUP_FAILED:
+        return True
+    mark_backup(store)
+    return False
+
+async def flush_cloud_backups(bot):
+    """Upload every store queued for a Telegram backup"""
+    while cloud_backup_pending:
+        store = cloud_backup_pending.pop()
+        get_data, filename = BACKUP_SOURCES[store]
+        if await backup_to_telegram(bot, store, get_data(), filename) == BACKUP_FAILED:
+            cloud_backup_pending.add(store)  # try again next round
+            break
+
+async def cloud_backup_flusher(bot):
+    """Upload queued backups at most once per BACKUP_INTERVAL"""
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        await flush_cloud_backups(bot)
+
+async def acquire_send_slot():
+    """Wait for room in the per-second send budget"""
+    await send_slots.acquire()
+    asyncio.get_running_loop().call_later(1, send_slots.release)
+
+async def send_with_retry(send):
+    """Run a send call, retrying only when Telegram cannot have acted on it"""
+    for attempt in range(SEND_RETRIES):
+        await acquire_send_slot()
+        try:
+            return await send()
+        except RetryAfter as e:
+            if attempt == SEND_RETRIES - 1:
+                raise
+            logger.warning("⏳ Flood limit hit, retrying in %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+        except NetworkError as e:
+            # A read timeout may mean the copy was already delivered; retrying would duplicate it
+            if attempt == SEND_RETRIES - 1 or not isinstance(e.__cause__, UNSENT_ERRORS):
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+def rebuild_deletion_heap():
+    """Index scheduled deletions by due time"""
+    global deletion_heap
+    deletion_heap = [(data['delete_at'], deletion_id) for deletion_id, data in scheduled_deletions.items()]
+    heapq.heapify(deletion_heap)
+    deletion_wakeup.set()
+
+def schedule_deletion(deletion_id, delete_at):
+    """Add a deletion to the due-time index and wake the scheduler"""
+    heapq.heappush(deletion_heap, (delete_at, deletion_id))
+    deletion_wakeup.set()
+
+async def deletion_scheduler(bot):
+    """Process deletions as soon as they fall due"""
+    while True:
+        deletion_wakeup.clear()
+        timeout = max(0, deletion_heap[0][0] - time.time()) if deletion_heap else None
+        try:
+            await asyncio.wait_for(deletion_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        
+        try:
+            await check_and_delete_due_messages(bot)
+        except Exception as e:
+            logger.error("❌ Deletion scheduler error: %s", e)
+
+async def copy_files_individually(bot, chat_id, file_ids):
+    """Copy files one message at a time, concurrently"""
+    async def copy_file(file_id):
+        sent_msg = await send_with_retry(lambda: bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=ADMIN_ID,
+            message_id=file_id
+        ))
+        return sent_msg.message_id
+    
+    results = await asyncio.gather(*(copy_file(file_id) for file_id in file_ids), return_exceptions=True)
+    
+    sent_message_ids = []
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Error forwarding file: %s", result)
+        else:
+            sent_message_ids.append(result)
+    return sent_message_ids
+
+async def copy_files(bot, chat_id, file_ids):
+    """Copy files into a chat in copyMessages batches, keeping their order"""
+    sent_message_ids = []
+    for i in range(0, len(file_ids), MESSAGE_BATCH_SIZE):
+        batch = file_ids[i:i + MESSAGE_BATCH_SIZE]
+        try:
+            copied = await send_with_retry(lambda: bot.copy_messages(chat_id=chat_id, from_chat_id=ADMIN_ID, message_ids=batch))
+            sent_message_ids.extend(msg.message_id for msg in copied)
+        except BadRequest as e:
+            # copyMessages needs strictly increasing IDs; fall back for hand-edited payloads
+            logger.warning("⚠️ Batch copy rejected, copying one by one: %s", e)
+            sent_message_ids.extend(await copy_files_individually(bot, chat_id, batch))
+        except Exception as e:
+            # The batch may have been delivered already; copying again would send it twice
+            logger.error("Error forwarding files %s: %s", batch, e)
+    return sent_message_ids
+
+def note_bad_attempt(user_id):
+    """Count an invalid link for a user; return False once they should be ignored"""
+    now = time.monotonic()
+    # Entries are inserted when their window opens, so expired ones sit at the front
+    while bad_attempts:
+        oldest = next(iter(bad_attempts))
+        if now - bad_attempts[oldest][1] <= INVALID_LINK_WINDOW:
+            break
+        del bad_attempts[oldest]
+    count, window_start = bad_attempts.get(user_id, (0, now))
+    count += 1
+    bad_attempts[user_id] = (count, window_start)
+    return count <= INVALID_LINK_LIMIT
+
+def admin_only(handler):
+    """Skip the handler for non-admin users; backs up the filter applied at registration"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id != ADMIN_ID:
+            logger.warning("⚠️ %s from non-admin %s got past the admin filter", handler.__name__, update.effective_user.id)
+            return
+        return await handler(update, context)
+    return wrapper
+
+def deletion_payloads(data):
+    """Short codes of the payloads delivered in one deletion entry"""
+    # Entries saved before bucketing carry a single 'payload' field
+    return ", ".join(payload[:8] for payload in data.get('payloads') or [data.get('payload', 'unknown')])
+
+async def process_deletion(bot, deletion_id):
+    """Delete one scheduled batch of messages and tell the user"""
+    data = scheduled_deletions[deletion_id]
+    chat_id = data['chat_id']
+    message_ids = data['message_ids']
+    payloads = deletion_payloads(data)
+    
+    deleted = 0
+    for i in range(0, len(message_ids), MESSAGE_BATCH_SIZE):
+        batch = message_ids[i:i + MESSAGE_BATCH_SIZE]
+        try:
+            await send_with_retry(lambda: bot.delete_messages(chat_id=chat_id, message_ids=batch))
+            deleted += len(batch)
+        except Exception as e:
+            logger.error("Could not delete messages %s: %s", batch, e)
+    
+    logger.info("🔥 Deleted %s/%s messages from chat %s (payloads: %s)", deleted, len(message_ids), chat_id, payloads)
+    
+    try:
+        await send_with_retry(lambda: bot.send_message(
+            chat_id=chat_id,
+            text="🔥 Files Auto-Deleted!\n\nYour 1-hour timer expired.\n🔄 Click the link again to get fresh copies!",
+            parse_mode=None
+        ))
     except Exception as e:
-        logger.error(f"❌ Error saving deletions: {e}")
+        logger.error("Could not send deletion notice: %s", e)
+    
+    # Dropped even on failure: a chat that blocked the bot will not start accepting deletes later
+    scheduled_deletions.pop(deletion_id, None)
 
 async def check_and_delete_due_messages(bot):
     """Check and process any overdue deletions"""
-    if not scheduled_deletions:
+    if not deletion_heap:
         return
     
-    current_time = datetime.now(timezone.utc).timestamp()
+    current_time = time.time()
     to_delete = []
     
-    for deletion_id, data in scheduled_deletions.items():
-        if current_time >= data['delete_at']:
+    while deletion_heap and deletion_heap[0][0] <= current_time:
+        _, deletion_id = heapq.heappop(deletion_heap)
+        if deletion_id in scheduled_deletions:
             to_delete.append(deletion_id)
     
     if not to_delete:
         return
     
-    logger.info(f"⚡ Found {len(to_delete)} overdue deletions to process")
+    logger.info("⚡ Found %s overdue deletions to process", len(to_delete))
     
-    for deletion_id in to_delete:
-        data = scheduled_deletions[deletion_id]
-        chat_id = data['chat_id']
-        message_ids = data['message_ids']
-        payload = data.get('payload', 'unknown')
-        
-        deleted = 0
-        for msg_id in message_ids:
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                deleted += 1
-            except Exception as e:
-                logger.error(f"Could not delete message {msg_id}: {e}")
-        
-        logger.info(f"🔥 Deleted {deleted}/{len(message_ids)} messages from chat {chat_id} (payload: {payload[:8]})")
-        
-        try:
-            await bot.send_message(
-                chat_id=chat_id,
-                text="🔥 Files Auto-Deleted!\n\nYour 1-hour timer expired.\n🔄 Click the link again to get fresh copies!",
-                parse_mode=None
-            )
-        except Exception as e:
-            logger.error(f"Could not send deletion notice: {e}")
-        
-        del scheduled_deletions[deletion_id]
+    await asyncio.gather(*(process_deletion(bot, deletion_id) for deletion_id in to_delete))
     
-    save_deletions()
-    logger.info(f"✅ Processed {len(to_delete)} overdue deletions")
+    mark_dirty('deletion')
+    logger.info("✅ Processed %s overdue deletions", len(to_delete))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /start command received from user {update.effective_user.id}")
+    logger.info("🎯 /start command received from user %s", update.effective_user.id)
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     
     if context.args:
         payload = context.args[0]
-        logger.info(f"📦 Payload requested: {payload}")
+        logger.info("📦 Payload requested: %s", payload)
         
-        if payload not in payload_data:
+        entry = payload_data.get(payload)
+        if entry is None:
+            if not note_bad_attempt(user_id):
+                return
             await update.message.reply_text("❌ Invalid link!")
             return
+        files = entry["files"]
         
+        # Start caption and warning go out as one message to save a send
         start_msg = caption_data.get("start_caption", "")
-        if start_msg:
-            await update.message.reply_text(start_msg, parse_mode=None)
-        
-        await update.message.reply_text(
+        warning = (
             f"⏰ IMPORTANT: 1 HOUR AUTO-DELETE!\n\n"
-            f"📦 Sending {len(payload_data[payload]['files'])} files...\n"
+            f"📦 Sending {len(files)} files...\n"
             f"⚠️ Files will be DELETED after 1 hour!\n"
-            f"💾 Forward them to Saved Messages NOW!",
+            f"💾 Forward them to Saved Messages NOW!"
+        )
+        await update.message.reply_text(
+            f"{start_msg}\n\n{warning}" if start_msg else warning,
             parse_mode=None
         )
         
-        sent_message_ids = []
-        success_count = 0
-        
-        for file_id in payload_data[payload]["files"]:
-            try:
-                sent_msg = await context.bot.copy_message(
-                    chat_id=chat_id,
-                    from_chat_id=ADMIN_ID,
-                    message_id=file_id
-                )
-                sent_message_ids.append(sent_msg.message_id)
-                success_count += 1
-            except Exception as e:
-                logger.error(f"Error forwarding file: {e}")
+        sent_message_ids = await copy_files(context.bot, chat_id, files)
+        success_count = len(sent_message_ids)
         
         end_msg = caption_data.get("end_caption", "")
         if end_msg:
@@ -342,26 +759,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=None
             )
         
-        deletion_id = f"{chat_id}_{int(time.time())}_{secrets.token_hex(4)}"
-        delete_at = datetime.now(timezone.utc).timestamp() + 3600
+        now = time.time()
+        # Round up so files never go before the promised hour is over
+        delete_at = -(-(now + 3600) // DELETION_BUCKET) * DELETION_BUCKET
+        deletion_id = f"{chat_id}_{int(delete_at)}"
         
-        scheduled_deletions[deletion_id] = {
-            'chat_id': chat_id,
-            'message_ids': sent_message_ids,
-            'delete_at': delete_at,
-            'payload': payload,
-            'scheduled_date': datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
-        }
-        save_deletions()
+        pending = scheduled_deletions.get(deletion_id)
+        if pending is None:
+            scheduled_deletions[deletion_id] = {
+                'chat_id': chat_id,
+                'message_ids': sent_message_ids,
+                'delete_at': delete_at,
+                'payloads': [payload]
+            }
+            schedule_deletion(deletion_id, delete_at)
+        else:
+            pending['message_ids'].extend(sent_message_ids)
+            payloads = pending.setdefault('payloads', [pending.pop('payload', payload)])
+            if payload not in payloads:
+                payloads.append(payload)
+        mark_dirty('deletion')
         
-        logger.info(f"⏰ Scheduled deletion {deletion_id}")
+        logger.info("⏰ Scheduled deletion %s", deletion_id)
         
-        if payload not in user_access:
-            user_access[payload] = {}
-        user_access[payload][str(user_id)] = time.time()
-        save_access()
+        access_time = int(now)
+        record_access(payload, user_id, access_time)
+        append_access(payload, user_id, access_time)
         
-        logger.info(f"✅ User {user_id} accessed payload {payload[:8]}")
+        logger.info("✅ User %s accessed payload %s", user_id, payload[:8])
         
     else:
         if user_id == ADMIN_ID:
@@ -373,7 +798,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "• /stopp - Finish and get link\n"
                 "• /setcaption - Set messages\n"
                 "• /status - View payloads\n"
-                "• /listpayloads - List all\n"
+                "• /listpayloads [page] - List all\n"
                 "• /deletepayload - Delete one\n"
                 "• /pending - View scheduled deletions\n"
                 "• /checkdeletions - Process overdue\n\n"
@@ -381,30 +806,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "• /backupnow - Backup all to Telegram\n"
                 "• /restorefromcloud - Restore from Telegram\n"
                 "• /downloadjson - Get current JSON\n"
-                "• /uploadjson - Upload JSON",
+                "• /uploadjson - Upload JSON\n\n"
+                "Other users get no reply to these commands.",
                 parse_mode=None
             )
         else:
             await update.message.reply_text("👋 Welcome! Send a valid link to access files.")
 
+@admin_only
 async def start_payload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /startp command received")
+    logger.info("🎯 /startp command received")
     user_id = update.effective_user.id
     
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
-    
     if not context.args:
         await update.message.reply_text("❌ Usage: /startp <name>\nExample: /startp movies")
         return
     
     payload_name = ' '.join(context.args)
-    admin_sessions[user_id] = {"payload": payload_name, "files": []}
+    async with state_lock:
+        admin_sessions[user_id] = {"payload": payload_name, "files": array.array('q')}
     
-    logger.info(f"✅ Started payload collection: {payload_name}")
+    logger.info("✅ Started payload collection: %s", payload_name)
     
     await update.message.reply_text(
         f"📁 Started: {payload_name}\n\n"
@@ -412,45 +834,42 @@ async def start_payload(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=None
     )
 
+@admin_only
 async def stop_payload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /stopp command received")
+    logger.info("🎯 /stopp command received")
     user_id = update.effective_user.id
     
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
-    
-    if user_id not in admin_sessions:
+    async with state_lock:
+        # The session ends here: files forwarded from now on are not added to any collection
+        session = admin_sessions.pop(user_id, None)
+        
+        if session is not None and session["files"]:
+            unique_payload = secrets.token_urlsafe(16)
+            created_at = time.time()
+            
+            payload_data[unique_payload] = {
+                "name": session['payload'],
+                "files": session["files"].tolist(),
+                "created_at": created_at,
+                "created_date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created_at))
+            }
+    
+    if session is None:
         await update.message.reply_text("❌ No active collection! Use /startp first.")
         return
     
-    session = admin_sessions[user_id]
-    
     if not session["files"]:
         await update.message.reply_text("❌ No files added!")
-        del admin_sessions[user_id]
         return
     
-    unique_payload = secrets.token_urlsafe(16)
-    
-    payload_data[unique_payload] = {
-        "name": session['payload'],
-        "files": session["files"],
-        "created_at": time.time(),
-        "created_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    
-    save_payloads()
-    await backup_to_telegram(context.bot, 'payload', payload_data, 'payload_data.json')
+    # Written now so the link survives a crash; the Telegram upload is batched
+    await save_store_async('payload')
+    mark_backup('payload')
     
-    bot_info = await context.bot.get_me()
-    share_link = f"https://t.me/{bot_info.username}?start={unique_payload}"
+    # Bot.initialize() already fetched get_me(); reuse the cached username
+    share_link = f"https://t.me/{context.bot.username}?start={unique_payload}"
     
-    logger.info(f"✅ Payload created: {unique_payload} with {len(session['files'])} files")
-    
-    del admin_sessions[user_id]
+    logger.info("✅ Payload created: %s with %s files", unique_payload, len(session['files']))
     
     await update.message.reply_text(
         f"✅ Collection Created!\n\n"
@@ -459,22 +878,16 @@ async def stop_payload(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔥 Auto-delete: 1 hour after sending\n"
         f"🔄 Reusable: Users can click again\n"
         f"🔑 Code: {unique_payload}\n"
-        f"☁️ Backed up to Telegram ✅\n\n"
+        f"☁️ Cloud backup pending (next upload within {BACKUP_INTERVAL:.0f}s)\n\n"
         f"🔗 Share Link:\n{share_link}",
         parse_mode=None
     )
 
+@admin_only
 async def set_caption(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
+    logger.info("🎯 /setcaption command received")
     
-    logger.info(f"🎯 /setcaption command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
-    
-    await update.message.reply_text(
+    prompt = await update.message.reply_text(
         "📝 Set Captions\n\n"
         "Reply with:\n"
         "START: your message\n"
@@ -485,66 +898,62 @@ async def set_caption(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Send 'CLEAR' to remove.",
         parse_mode=None
     )
+    caption_prompt_ids.append(prompt.message_id)
 
+@admin_only
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /status command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /status command received")
     
     if not payload_data:
         await update.message.reply_text("📊 No payloads.")
         return
     
-    status_text = f"📊 Payloads: {len(payload_data)}\n\n"
+    parts = [f"📊 Payloads: {len(payload_data)}\n\n"]
     
-    for payload, data in list(payload_data.items())[:10]:
+    for payload, data in islice(payload_data.items(), 10):
         access_count = len(user_access.get(payload, {}))
-        status_text += f"• {data.get('name', 'Unnamed')}\n"
-        status_text += f"  Files: {len(data['files'])} | Users: {access_count}\n"
-        status_text += f"  Code: {payload[:12]}...\n\n"
+        parts.append(
+            f"• {data.get('name', 'Unnamed')}\n"
+            f"  Files: {len(data['files'])} | Users: {access_count}\n"
+            f"  Code: {payload[:12]}...\n\n"
+        )
     
-    await update.message.reply_text(status_text, parse_mode=None)
+    await update.message.reply_text("".join(parts), parse_mode=None)
 
+@admin_only
 async def list_payloads(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /listpayloads command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /listpayloads command received")
     
     if not payload_data:
         await update.message.reply_text("📊 No payloads.")
         return
     
-    list_text = "📋 All Payloads:\n\n"
+    pages = (len(payload_data) + PAYLOADS_PER_PAGE - 1) // PAYLOADS_PER_PAGE
+    try:
+        page = int(context.args[0]) if context.args else 1
+    except ValueError:
+        page = 1
+    page = min(max(page, 1), pages)
+    start_index = (page - 1) * PAYLOADS_PER_PAGE
     
-    for i, (payload, data) in enumerate(payload_data.items(), 1):
+    parts = [f"📋 All Payloads (page {page}/{pages}):\n\n"]
+    
+    page_items = islice(payload_data.items(), start_index, start_index + PAYLOADS_PER_PAGE)
+    for i, (payload, data) in enumerate(page_items, start_index + 1):
         access_count = len(user_access.get(payload, {}))
         created = data.get('created_date', 'Unknown')
-        list_text += f"{i}. {data.get('name', 'Unnamed')}\n"
-        list_text += f"   Created: {created}\n"
-        list_text += f"   Files: {len(data['files'])} | Users: {access_count}\n"
-        list_text += f"   Code: {payload}\n\n"
+        parts.append(
+            f"{i}. {data.get('name', 'Unnamed')}\n"
+            f"   Created: {created}\n"
+            f"   Files: {len(data['files'])} | Users: {access_count}\n"
+            f"   Code: {payload}\n\n"
+        )
     
-    await update.message.reply_text(list_text, parse_mode=None)
+    await update.message.reply_text("".join(parts), parse_mode=None)
 
+@admin_only
 async def delete_payload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /deletepayload command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /deletepayload command received")
     
     if not context.args:
         await update.message.reply_text("❌ Usage: /deletepayload <code>")
@@ -552,61 +961,57 @@ async def delete_payload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     payload = context.args[0]
     
-    if payload not in payload_data:
+    async with state_lock:
+        entry = payload_data.pop(payload, None)
+        
+        if entry is not None:
+            for user_id in user_access.pop(payload, {}):
+                user_payloads[user_id].discard(payload)
+                if not user_payloads[user_id]:
+                    del user_payloads[user_id]
+    
+    if entry is None:
         await update.message.reply_text("❌ Not found!")
         return
     
-    name = payload_data[payload].get('name', 'Unnamed')
-    del payload_data[payload]
+    name = entry.get('name', 'Unnamed')
+    mark_dirty('access')
+    await save_store_async('payload')
+    mark_backup('payload')
     
-    if payload in user_access:
-        del user_access[payload]
-    
-    save_payloads()
-    save_access()
-    await backup_to_telegram(context.bot, 'payload', payload_data, 'payload_data.json')
-    
-    await update.message.reply_text(f"✅ Deleted: {name}\n☁️ Backup updated!", parse_mode=None)
+    await update.message.reply_text(f"✅ Deleted: {name}\n☁️ Cloud backup pending!", parse_mode=None)
 
+@admin_only
 async def pending_deletions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
-    
-    logger.info(f"🎯 /pending command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /pending command received")
     
     if not scheduled_deletions:
         await update.message.reply_text("📊 No pending deletions.")
         return
     
-    current_time = datetime.now(timezone.utc).timestamp()
-    pending_text = f"⏰ Scheduled Deletions: {len(scheduled_deletions)}\n\n"
+    current_time = time.time()
+    parts = [f"⏰ Scheduled Deletions: {len(scheduled_deletions)}\n\n"]
     
-    for deletion_id, data in list(scheduled_deletions.items())[:20]:
+    for deletion_id, data in islice(scheduled_deletions.items(), 20):
         delete_at = data['delete_at']
         time_left = int((delete_at - current_time) / 60)
-        payload = data.get('payload', 'unknown')[:8]
+        payloads = deletion_payloads(data)
         chat_id = data['chat_id']
         num_files = len(data['message_ids'])
         
         status = "⏳ Pending" if time_left > 0 else "⚡ OVERDUE"
         
-        pending_text += f"• Chat {chat_id} | Payload: {payload}\n"
-        pending_text += f"  Files: {num_files} | {status}\n"
-        pending_text += f"  Time: {time_left} min\n\n"
+        parts.append(
+            f"• Chat {chat_id} | Payloads: {payloads}\n"
+            f"  Files: {num_files} | {status}\n"
+            f"  Time: {time_left} min\n\n"
+        )
     
-    await update.message.reply_text(pending_text, parse_mode=None)
+    await update.message.reply_text("".join(parts), parse_mode=None)
 
+@admin_only
 async def check_deletions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"🎯 /checkdeletions command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /checkdeletions command received")
     
     await update.message.reply_text("⚡ Checking for overdue deletions...")
     
@@ -624,50 +1029,46 @@ async def check_deletions_command(update: Update, context: ContextTypes.DEFAULT_
     else:
         await update.message.reply_text(f"✅ All clear! No overdue deletions.\n\nPending: {after_count}")
 
+@admin_only
 async def backup_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manually backup all data to Telegram"""
-    logger.info(f"🎯 /backupnow command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /backupnow command received")
     
     await update.message.reply_text("☁️ Starting backup to Telegram...")
     
-    success_count = 0
-    
-    if await backup_to_telegram(context.bot, 'payload', payload_data, 'payload_data.json'):
-        success_count += 1
-    
-    if await backup_to_telegram(context.bot, 'access', user_access, 'user_access.json'):
-        success_count += 1
-    
-    if await backup_to_telegram(context.bot, 'caption', caption_data, 'caption_data.json'):
-        success_count += 1
-    
-    if await backup_to_telegram(context.bot, 'deletion', scheduled_deletions, 'scheduled_deletions.json'):
-        success_count += 1
+    # The admin asked for fresh copies, so upload even unchanged stores
+    results = [
+        await backup_to_telegram(context.bot, 'payload', payload_data, 'payload_data.json', force=True),
+        await backup_to_telegram(context.bot, 'access', user_access, 'user_access.json', force=True),
+        await backup_to_telegram(context.bot, 'caption', caption_data, 'caption_data.json', force=True),
+        await backup_to_telegram(context.bot, 'deletion', scheduled_deletions, 'scheduled_deletions.json', force=True),
+    ]
+    uploaded = results.count(BACKUP_UPLOADED)
+    unchanged = results.count(BACKUP_UNCHANGED)
+    failed = results.count(BACKUP_FAILED)
+    
+    parts = [
+        "✅ Backup Complete!\n\n" if not failed else "⚠️ Backup Incomplete!\n\n",
+        f"📤 Uploaded {uploaded}/{len(results)} files to Telegram\n",
+    ]
+    if unchanged:
+        parts.append(f"⏭️ Unchanged, not re-uploaded: {unchanged}\n")
+    if failed:
+        parts.append(f"❌ Failed: {failed}\n")
+    else:
+        parts.append("☁️ Your data is now safe in the cloud!")
     
-    await update.message.reply_text(
-        f"✅ Backup Complete!\n\n"
-        f"📤 Uploaded {success_count}/4 files to Telegram\n"
-        f"☁️ Your data is now safe in the cloud!",
-        parse_mode=None
-    )
+    await update.message.reply_text("".join(parts), parse_mode=None)
 
+@admin_only
 async def restore_from_cloud(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manually restore all data from Telegram"""
-    logger.info(f"🎯 /restorefromcloud command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /restorefromcloud command received")
     
     await update.message.reply_text("☁️ Restoring from Telegram backups...")
     
-    restored = await load_data_from_telegram(context.bot)
+    async with state_lock:
+        restored = await load_data_from_telegram(context.bot)
     
     if restored:
         await update.message.reply_text(
@@ -685,38 +1086,27 @@ async def restore_from_cloud(update: Update, context: ContextTypes.DEFAULT_TYPE)
             parse_mode=None
         )
 
+@admin_only
 async def download_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send current JSON files to admin"""
-    logger.info(f"🎯 /downloadjson command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /downloadjson command received")
     
     await update.message.reply_text("📥 Generating JSON files...")
     
-    json_str = json.dumps(payload_data, indent=2)
-    file_obj = io.BytesIO(json_str.encode('utf-8'))
-    file_obj.name = 'payload_data.json'
-    
     await context.bot.send_document(
         chat_id=ADMIN_ID,
-        document=file_obj,
+        document=orjson.dumps(payload_data, option=orjson.OPT_INDENT_2),
+        filename='payload_data.json',
         caption=f"📦 Payload Data\n📊 Records: {len(payload_data)}",
         parse_mode=None
     )
     
     await update.message.reply_text("✅ JSON file sent!")
 
+@admin_only
 async def upload_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Upload and set payload data from JSON file"""
-    logger.info(f"🎯 /uploadjson command received")
-    user_id = update.effective_user.id
-    
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin only!")
-        return
+    logger.info("🎯 /uploadjson command received")
     
     await update.message.reply_text(
         "📤 Upload JSON File\n\n"
@@ -728,126 +1118,131 @@ async def upload_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=None
     )
 
-async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await check_and_delete_due_messages(context.bot)
+def looks_like_payloads(data):
+    """Check the shape of an uploaded file against payload_data.json"""
+    if not isinstance(data, dict) or not data:
+        return False
+    entry = next(iter(data.values()))
+    return isinstance(entry, dict) and 'name' in entry and 'files' in entry
+
+async def handle_json_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Replace payload or caption data from an uploaded JSON file"""
+    doc = update.message.document
+    logger.info("📄 JSON file received: %s", doc.file_name)
     
-    logger.info(f"📨 Message received from user {update.effective_user.id}")
-    user_id = update.effective_user.id
+    processing_msg = await update.message.reply_text("⏳ Processing JSON file...")
     
-    if update.message.document and user_id == ADMIN_ID:
-        doc = update.message.document
-        
-        if doc.file_name and doc.file_name.endswith('.json'):
-            logger.info(f"📄 JSON file received: {doc.file_name}")
-            
-            processing_msg = await update.message.reply_text("⏳ Processing JSON file...")
+    # Held across the download so a /stopp in between is not overwritten by the old dict
+    async with state_lock:
+        try:
+            file = await context.bot.get_file(doc.file_id)
+            file_bytes = await file.download_as_bytearray()
+            new_data = orjson.loads(file_bytes)
             
-            try:
-                file = await context.bot.get_file(doc.file_id)
-                file_bytes = await file.download_as_bytearray()
-                json_str = file_bytes.decode('utf-8')
-                new_data = json.loads(json_str)
+            if looks_like_payloads(new_data):
+                global payload_data
+                old_count = len(payload_data)
+                payload_data = new_data
+                backed_up = await backup_store_now(context.bot, 'payload')
                 
-                if 'name' in str(new_data) and 'files' in str(new_data):
-                    global payload_data
-                    old_count = len(payload_data)
-                    payload_data = new_data
-                    save_payloads()
-                    
-                    await backup_to_telegram(context.bot, 'payload', payload_data, 'payload_data.json')
-                    
-                    logger.info(f"✅ Loaded {len(payload_data)} payloads from uploaded file")
-                    
-                    await processing_msg.delete()
-                    
-                    await update.message.reply_text(
-                        f"✅ Payload Data Uploaded!\n\n"
-                        f"📦 Previous: {old_count} payloads\n"
-                        f"📦 New: {len(payload_data)} payloads\n"
-                        f"☁️ Backed up to Telegram cloud\n\n"
-                        f"🚀 Bot is ready to use!",
-                        parse_mode=None
-                    )
-                    return
+                logger.info("✅ Loaded %s payloads from uploaded file", len(payload_data))
                 
-                elif 'start_caption' in new_data or 'end_caption' in new_data:
-                    global caption_data
-                    caption_data = new_data
-                    save_captions()
-                    await backup_to_telegram(context.bot, 'caption', caption_data, 'caption_data.json')
-                    
-                    await processing_msg.delete()
-                    await update.message.reply_text(
-                        "✅ Caption Data Uploaded!\n\n☁️ Backed up to cloud",
-                        parse_mode=None
-                    )
-                    return
+                await processing_msg.edit_text(
+                    f"✅ Payload Data Uploaded!\n\n"
+                    f"📦 Previous: {old_count} payloads\n"
+                    f"📦 New: {len(payload_data)} payloads\n"
+                    f"{'☁️ Backed up to Telegram cloud' if backed_up else '⚠️ Cloud backup failed, retrying in background'}\n\n"
+                    f"🚀 Bot is ready to use!",
+                    parse_mode=None
+                )
+                return
+            
+            elif 'start_caption' in new_data or 'end_caption' in new_data:
+                global caption_data
+                caption_data = new_data
+                backed_up = await backup_store_now(context.bot, 'caption')
                 
-                else:
-                    await processing_msg.delete()
-                    await update.message.reply_text(
-                        "⚠️ Unknown JSON format!\n\n"
-                        "Expected: payload_data.json or caption_data.json"
-                    )
-                    return
-                    
-            except json.JSONDecodeError as e:
-                logger.error(f"❌ Invalid JSON: {e}")
-                await processing_msg.delete()
-                await update.message.reply_text(f"❌ Invalid JSON file!\n\nError: {str(e)}")
+                await processing_msg.edit_text(
+                    f"✅ Caption Data Uploaded!\n\n{'☁️ Backed up to cloud' if backed_up else '⚠️ Cloud backup failed, retrying in background'}",
+                    parse_mode=None
+                )
                 return
-            except Exception as e:
-                logger.error(f"❌ Upload error: {e}")
-                await processing_msg.delete()
-                await update.message.reply_text(f"❌ Error: {str(e)}")
+            
+            else:
+                await processing_msg.edit_text(
+                    "⚠️ Unknown JSON format!\n\n"
+                    "Expected: payload_data.json or caption_data.json"
+                )
                 return
+                
+        except orjson.JSONDecodeError as e:
+            logger.error("❌ Invalid JSON: %s", e)
+            await processing_msg.edit_text(f"❌ Invalid JSON file!\n\nError: {str(e)}")
+            return
+        except Exception as e:
+            logger.error("❌ Upload error: %s", e)
+            await processing_msg.edit_text(f"❌ Error: {str(e)}")
+            return
+
+async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("📨 Message received from user %s", update.effective_user.id)
+    user_id = update.effective_user.id
     
     if update.message.reply_to_message:
-        reply_text = update.message.reply_to_message.text
-        if reply_text and "Set Captions" in reply_text and user_id == ADMIN_ID:
+        if update.message.reply_to_message.message_id in caption_prompt_ids:
             text = update.message.text
+            cleared = len(text) == 5 and text.upper() == 'CLEAR'
             
-            if text.upper() == 'CLEAR':
-                caption_data["start_caption"] = ""
-                caption_data["end_caption"] = ""
-                save_captions()
-                await backup_to_telegram(context.bot, 'caption', caption_data, 'caption_data.json')
-                await update.message.reply_text("✅ Captions cleared and backed up!")
-                return
-            
-            if 'START:' in text:
-                parts = text.split('START:')
-                if len(parts) > 1:
-                    start = parts[1].split('END:')[0].strip()
-                    caption_data["start_caption"] = start
-            
-            if 'END:' in text:
-                parts = text.split('END:')
-                if len(parts) > 1:
-                    caption_data["end_caption"] = parts[1].strip()
+            async with state_lock:
+                if cleared:
+                    caption_data["start_caption"] = ""
+                    caption_data["end_caption"] = ""
+                else:
+                    _, found, rest = text.partition('START:')
+                    if found:
+                        caption_data["start_caption"] = rest.partition('END:')[0].strip()
+                    
+                    _, found, rest = text.partition('END:')
+                    if found:
+                        caption_data["end_caption"] = rest.strip()
+                
+                mark_dirty('caption')
+                mark_backup('caption')
             
-            save_captions()
-            await backup_to_telegram(context.bot, 'caption', caption_data, 'caption_data.json')
-            await update.message.reply_text("✅ Captions updated and backed up!")
+            await update.message.reply_text(f"✅ Captions {'cleared' if cleared else 'updated'}! ☁️ Cloud backup queued.")
+            return
+    
+    async with state_lock:
+        session = admin_sessions.get(user_id)
+        if session is None:
             return
+        session["files"].append(update.message.message_id)
+        count = len(session["files"])
     
-    if user_id == ADMIN_ID and user_id in admin_sessions:
-        message_id = update.message.message_id
-        admin_sessions[user_id]["files"].append(message_id)
-        count = len(admin_sessions[user_id]["files"])
-        logger.info(f"✅ File #{count} added to collection")
+    logger.info("✅ File #%s added to collection", count)
+    # Acknowledge the first few files, then every tenth; /stopp reports the total
+    if count <= 3 or count % 10 == 0:
         await update.message.reply_text(f"✅ File #{count}")
 
+ADMIN_COMMANDS = (
+    ("startp", start_payload),
+    ("stopp", stop_payload),
+    ("setcaption", set_caption),
+    ("status", status),
+    ("listpayloads", list_payloads),
+    ("deletepayload", delete_payload),
+    ("pending", pending_deletions),
+    ("checkdeletions", check_deletions_command),
+    ("backupnow", backup_now),
+    ("restorefromcloud", restore_from_cloud),
+    ("downloadjson", download_json),
+    ("uploadjson", upload_json),
+)
+
 async def notify_admin_restart():
     """Notify admin that bot restarted"""
     try:
-        await asyncio.sleep(2)
-        
-        await check_and_delete_due_messages(bot_app.bot)
-        
-        has_data = len(payload_data) > 0
-        
-        if has_data:
+        if payload_data:
             message = (
                 "🔄 Bot Restarted!\n\n"
                 f"📦 Payloads: {len(payload_data)}\n"
@@ -855,11 +1250,7 @@ async def notify_admin_restart():
                 "✅ Ready to use!"
             )
         else:
-            message = (
-                "🔄 Bot Restarted!\n\n"
-                "⚠️ No payload data found!\n\n"
-                "📤 Send your payload_data.json file anytime."
-            )
+            message = NO_DATA_RESTART_MESSAGE
         
         await bot_app.bot.send_message(
             chat_id=ADMIN_ID,
@@ -869,181 +1260,224 @@ async def notify_admin_restart():
         logger.info("✅ Admin notified of restart")
                 
     except Exception as e:
-        logger.error(f"❌ Could not notify admin: {e}")
+        logger.error("❌ Could not notify admin: %s", e)
 
-def keep_alive_sync():
-    """Keep the service alive by pinging itself every 10 minutes"""
-    while True:
-        time.sleep(600)  # 10 minutes = 600 seconds
-        try:
-            if WEBHOOK_URL:
-                ping_url = f"{WEBHOOK_URL}/health"
-                response = requests.get(ping_url, timeout=10)
+async def keep_alive():
+    """Keep the service alive by pinging itself every KEEP_ALIVE_INTERVAL seconds"""
+    ping_url = f"{WEBHOOK_URL}/health"
+    async with httpx.AsyncClient(timeout=10) as client:
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            try:
+                # HEAD is enough to count as traffic and skips the response body
+                response = await client.head(ping_url)
                 if response.status_code == 200:
                     logger.info("💓 Keep-alive ping SUCCESS")
                 else:
-                    logger.warning(f"⚠️ Keep-alive ping returned: {response.status_code}")
-        except Exception as e:
-            logger.error(f"❌ Keep-alive ping failed: {e}")
+                    logger.warning("⚠️ Keep-alive ping returned: %s", response.status_code)
+            except Exception as e:
+                logger.error("❌ Keep-alive ping failed: %s", e)
+
+def is_ignorable_update(update_data):
+    """True for raw updates no handler would act on: non-admin messages other than /start"""
+    message = update_data.get("message") or update_data.get("edited_message")
+    if not message:
+        return False
+    sender_id = (message.get("from") or {}).get("id")
+    if sender_id == ADMIN_ID:
+        return False
+    return not (message.get("text") or "").startswith("/start")
 
 @app.route('/')
-def index():
+async def index():
     return "Bot running! 🚀", 200
 
 @app.route('/health')
-def health():
+async def health():
     return "OK", 200
 
 @app.route('/<token>', methods=['POST'])
-def webhook(token):
+async def webhook(token):
     """Handle incoming webhook updates"""
     
-    if token != BOT_TOKEN:
-        logger.error(f"❌ Invalid token in webhook: {token}")
+    if not hmac.compare_digest(token.encode(), BOT_TOKEN_BYTES):
+        logger.error("❌ Invalid token in webhook: %s", token)
         return "Unauthorized", 401
     
     logger.info("🔔 Webhook received!")
     
-    if not bot_app or not bot_loop:
-        logger.error("❌ Bot app or loop not initialized!")
+    if not bot_app:
+        logger.error("❌ Bot app not initialized!")
         return "Bot not ready", 503
     
     try:
-        update_data = request.get_json(force=True)
-        logger.info(f"📦 Update received")
+        update_data = orjson.loads(await request.get_data(cache=False))
+        if is_ignorable_update(update_data):
+            return "OK", 200
+        logger.info("📦 Update received")
         
         update = Update.de_json(update_data, bot_app.bot)
         
-        # ✅ FIX: Schedule coroutine in the persistent event loop
-        future = asyncio.run_coroutine_threadsafe(
-            bot_app.process_update(update),
-            bot_loop
-        )
-        
-        # Wait for completion (with timeout)
-        try:
-            future.result(timeout=30)  # 30 second timeout
-            logger.info("✅ Update processed")
-        except Exception as e:
-            logger.error(f"❌ Update processing error: {e}")
+        # Hand the update to the running application and answer Telegram right away
+        await bot_app.update_queue.put(update)
         
+    except orjson.JSONDecodeError as e:
+        logger.error("❌ Invalid webhook body: %s", e)
+        return "Bad Request", 400
     except Exception as e:
-        logger.error(f"❌ Webhook error: {e}", exc_info=True)
+        logger.error("❌ Webhook error: %s", e, exc_info=True)
         return "Error", 500
     
     return "OK", 200
 
-def run_flask():
-    """Run Flask"""
-    logger.info(f"🌐 Flask starting on port {PORT}")
-    app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
+async def run_server(stop_event):
+    """Serve the Quart app on the running event loop until stop_event is set"""
+    logger.info("🌐 Hypercorn starting on port %s", PORT)
+    config = Config()
+    config.bind = [f"0.0.0.0:{PORT}"]
+    await serve(app, config, shutdown_trigger=stop_event.wait)
+
+async def shutdown():
+    """Stop background work and flush state before exiting"""
+    logger.info("🛑 Shutting down...")
+    
+    async with contextlib.AsyncExitStack() as stack:
+        # Let any in-flight worker-thread write finish before the final synchronous flush
+        for lock in store_locks.values():
+            await stack.enter_async_context(lock)
+        
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        
+        flush_dirty_stores()
+    
+    await flush_cloud_backups(bot_app.bot)
+    
+    if BOT_MODE == "polling":
+        await bot_app.updater.stop()
+    await bot_app.stop()
+    await bot_app.shutdown()
+    logger.info("👋 Bot stopped")
 
-def run_event_loop(loop):
-    """Run the asyncio event loop in a separate thread"""
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
+async def start_polling():
+    """Fetch updates with long polling instead of a webhook"""
+    await bot_app.updater.start_polling(drop_pending_updates=True)
+    await bot_app.start()
 
-def main():
+async def main():
     """Main function"""
-    global bot_app, bot_loop
+    global bot_app
     
     logger.info("=" * 60)
     logger.info("🚀 TELEGRAM BOT STARTING - CLOUD BACKUP VERSION")
     logger.info("=" * 60)
-    logger.info(f"📝 BOT_TOKEN: {'SET ✅' if BOT_TOKEN else 'MISSING ❌'}")
-    logger.info(f"👤 ADMIN_ID: {ADMIN_ID}")
-    logger.info(f"🌐 WEBHOOK_URL: {WEBHOOK_URL if WEBHOOK_URL else 'MISSING ❌'}")
-    logger.info(f"🔌 PORT: {PORT}")
+    logger.info("📝 BOT_TOKEN: %s", 'SET ✅' if BOT_TOKEN else 'MISSING ❌')
+    logger.info("👤 ADMIN_ID: %s", ADMIN_ID)
+    logger.info("🌐 WEBHOOK_URL: %s", WEBHOOK_URL if WEBHOOK_URL else 'MISSING ❌')
+    logger.info("🔌 PORT: %s", PORT)
+    logger.info("📡 BOT_MODE: %s", BOT_MODE)
     logger.info("=" * 60)
     
-    if not WEBHOOK_URL:
+    if BOT_MODE != "polling" and not WEBHOOK_URL:
         logger.warning("⚠️ WEBHOOK_URL not set - webhook will not work!")
     
+    # Store writes run through asyncio.to_thread; a few threads are plenty
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=IO_WORKERS))
+    
     load_backup_ids()
     load_data()
     
     logger.info("🤖 Creating bot application...")
-    bot_app = Application.builder().token(BOT_TOKEN).updater(None).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # The builder's pool already has 256 connections; give bursts time to get one
+        .pool_timeout(30.0)
+        .connect_timeout(10.0)
+        .read_timeout(30.0)
+        # Let a long /start delivery run alongside other chats' updates
+        .concurrent_updates(True)
+    )
+    if BOT_MODE != "polling":
+        builder = builder.updater(None)
+    bot_app = builder.build()
     
     logger.info("📌 Adding handlers...")
+    # Non-admin updates for admin commands and messages are dropped before any callback runs
+    admin_filter = filters.User(user_id=ADMIN_ID)
     bot_app.add_handler(CommandHandler("start", start))
-    bot_app.add_handler(CommandHandler("startp", start_payload))
-    bot_app.add_handler(CommandHandler("stopp", stop_payload))
-    bot_app.add_handler(CommandHandler("setcaption", set_caption))
-    bot_app.add_handler(CommandHandler("status", status))
-    bot_app.add_handler(CommandHandler("listpayloads", list_payloads))
-    bot_app.add_handler(CommandHandler("deletepayload", delete_payload))
-    bot_app.add_handler(CommandHandler("pending", pending_deletions))
-    bot_app.add_handler(CommandHandler("checkdeletions", check_deletions_command))
-    bot_app.add_handler(CommandHandler("backupnow", backup_now))
-    bot_app.add_handler(CommandHandler("restorefromcloud", restore_from_cloud))
-    bot_app.add_handler(CommandHandler("downloadjson", download_json))
-    bot_app.add_handler(CommandHandler("uploadjson", upload_json))
-    bot_app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_messages))
-    
-    # ✅ Create persistent event loop
-    logger.info("🔄 Creating persistent event loop...")
-    bot_loop = asyncio.new_event_loop()
-    
-    # ✅ Start event loop in separate thread
-    loop_thread = Thread(target=run_event_loop, args=(bot_loop,), daemon=True)
-    loop_thread.start()
-    logger.info("✅ Event loop thread started")
+    for command, callback in ADMIN_COMMANDS:
+        bot_app.add_handler(CommandHandler(command, callback, filters=admin_filter))
+    bot_app.add_handler(MessageHandler(admin_filter & filters.Document.FileExtension("json"), handle_json_upload))
+    bot_app.add_handler(MessageHandler(admin_filter & ~filters.COMMAND, handle_messages))
     
     logger.info("⚙️ Initializing bot...")
-    future = asyncio.run_coroutine_threadsafe(bot_app.initialize(), bot_loop)
-    future.result()  # Wait for initialization
+    await bot_app.initialize()
     
     logger.info("☁️ Checking for cloud backups...")
-    future = asyncio.run_coroutine_threadsafe(load_data_from_telegram(bot_app.bot), bot_loop)
-    future.result()  # Wait for loading
+    await load_data_from_telegram(bot_app.bot)
     
-    if WEBHOOK_URL:
-        webhook_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
-        logger.info(f"🔗 Setting webhook: {webhook_url}")
-        
-        logger.info("🗑️ Deleting old webhook...")
-        future = asyncio.run_coroutine_threadsafe(
-            bot_app.bot.delete_webhook(drop_pending_updates=True),
-            bot_loop
-        )
-        future.result()
+    background_tasks.append(asyncio.create_task(access_log_compactor()))
+    logger.info("🗜️ Access log compactor started")
+    
+    if ACCESS_TTL:
+        background_tasks.append(asyncio.create_task(access_sweeper()))
+        logger.info("🧹 Access sweeper started (TTL %ss)", ACCESS_TTL)
+    
+    background_tasks.append(asyncio.create_task(deletion_scheduler(bot_app.bot)))
+    logger.info("⏰ Deletion scheduler started")
+    
+    background_tasks.append(asyncio.create_task(dirty_store_flusher()))
+    logger.info("💾 Background flusher started")
+    
+    background_tasks.append(asyncio.create_task(cloud_backup_flusher(bot_app.bot)))
+    logger.info("☁️ Cloud backup flusher started")
+    
+    if BOT_MODE == "polling":
+        logger.info("📡 Starting long polling...")
+        await start_polling()
+        logger.info("✅ Polling started!")
         
-        time.sleep(2)
+        await notify_admin_restart()
+    else:
+        await bot_app.start()
+        logger.info("📥 Update queue started")
+    
+    if BOT_MODE != "polling" and WEBHOOK_URL:
+        webhook_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
+        logger.info("🔗 Setting webhook: %s", webhook_url)
         
-        future = asyncio.run_coroutine_threadsafe(
-            bot_app.bot.set_webhook(url=webhook_url),
-            bot_loop
-        )
-        future.result()
+        # setWebhook replaces any existing hook, so no delete + wait is needed first
+        await bot_app.bot.set_webhook(url=webhook_url, drop_pending_updates=True)
         logger.info("✅ Webhook configured!")
         
-        future = asyncio.run_coroutine_threadsafe(bot_app.bot.get_webhook_info(), bot_loop)
-        webhook_info = future.result()
-        logger.info(f"📡 Webhook URL: {webhook_info.url}")
-        logger.info(f"📡 Pending updates: {webhook_info.pending_update_count}")
-        
-        future = asyncio.run_coroutine_threadsafe(notify_admin_restart(), bot_loop)
-        future.result()
+        webhook_info, _ = await asyncio.gather(bot_app.bot.get_webhook_info(), notify_admin_restart())
+        logger.info("📡 Webhook URL: %s", webhook_info.url)
+        logger.info("📡 Pending updates: %s", webhook_info.pending_update_count)
     
     if WEBHOOK_URL:
-        keep_alive_thread = Thread(target=keep_alive_sync, daemon=True)
-        keep_alive_thread.start()
-        logger.info("💓 Keep-alive thread started")
+        background_tasks.append(asyncio.create_task(keep_alive()))
+        logger.info("💓 Keep-alive task started")
     
     logger.info("=" * 60)
     logger.info("✅ BOT IS READY - CLOUD BACKUP ENABLED!")
     logger.info("=" * 60)
     
-    run_flask()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await run_server(stop_event)
+    await shutdown()
 
 if __name__ == "__main__":
     try:
-        import nest_asyncio
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ Using uvloop")
     except ImportError:
-        import subprocess
-        import sys
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "nest_asyncio"])
-        import nest_asyncio
+        pass
     
-    main()
+    asyncio.run(main())